@@ -1,34 +1,59 @@
+import ast
+import asyncio
+import builtins
+import contextlib
+import logging
 import os
+import re
+import secrets
 import click
+from functools import lru_cache
 import uvicorn
 from dotenv import load_dotenv
-from llama_index.core import StorageContext, load_index_from_storage
-from llama_index.core.agent.workflow import FunctionAgent
+from llama_index.core import QueryBundle, Settings, StorageContext, load_index_from_storage
+from llama_index.core.agent.workflow import AgentStream, FunctionAgent
 from llama_index.llms.openai import OpenAI
 
 from a2a.types import (
-    AgentCard, AgentCapabilities, AgentSkill, TaskState, TextPart
+    AgentCard, AgentCapabilities, AgentSkill, Artifact, TaskArtifactUpdateEvent, TaskState, TextPart
 )
 from a2a.server.request_handlers import DefaultRequestHandler
-from a2a.server.tasks import InMemoryTaskStore, TaskUpdater
+from a2a.server.tasks import TaskUpdater
 from a2a.server.apps import A2AStarletteApplication
 from a2a.server.agent_execution import AgentExecutor
 from a2a.server.agent_execution.context import RequestContext
 from a2a.server.events import EventQueue
+from starlette.applications import Starlette
+
+from redis_task_store import create_task_store
+from server_utils import agent_card_route, configure_logging, run_workers
 
 load_dotenv()
 
+logger = logging.getLogger("expert_agent")
+
 if not os.getenv("OPENAI_API_KEY"):
     raise ValueError("OPENAI_API_KEY not found. Please check your .env file.")
 
-try:
-    storage_context = StorageContext.from_defaults(persist_dir="storage")
-    index = load_index_from_storage(storage_context)
-    query_engine = index.as_query_engine()
-    print("Document index loaded successfully")
-except Exception as e:
-    print(f"Warning: Could not load document index: {e}")
-    query_engine = None
+query_engine = None
+
+def load_query_engine():
+    """Читает индекс документов с диска; синхронно, поэтому вызывается в отдельном потоке"""
+    try:
+        storage_context = StorageContext.from_defaults(persist_dir="storage")
+        index = load_index_from_storage(storage_context)
+        logger.info("Document index loaded successfully")
+        return index.as_query_engine()
+    except Exception as e:
+        logger.warning("Could not load document index: %s", e)
+        return None
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    """Загружает индекс документов при запуске сервера, не блокируя цикл событий"""
+    global query_engine
+    query_engine = await asyncio.to_thread(load_query_engine)
+    yield
 
 COMPANY_DATA = """
 Our company 'AI Solutions Corp' specialises in developing advanced AI solutions for businesses.
@@ -54,33 +79,175 @@ Founded in 2020, over 500 successful implementations, offices in 15 countries.
 24/7 technical support, 30 days money back guarantee.
 """
 
+class MicroBatcher:
+    """Собирает одновременные запросы в пачки и обрабатывает каждую пачку одним вызовом.
+
+    Пачка отправляется, когда набралось max_size запросов или прошло max_wait секунд
+    с момента прихода первого из них. Вместо результата отдельного запроса обработчик
+    может вернуть исключение - оно достанется только этому запросу.
+    """
+
+    def __init__(self, handler, max_size: int, max_wait: float):
+        self._handler = handler
+        self._max_size = max_size
+        self._max_wait = max_wait
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._collector: asyncio.Task | None = None
+        self._flushes: set[asyncio.Task] = set()
+
+    async def submit(self, item):
+        """Ставит запрос в очередь и ждет результат его пачки"""
+        if self._collector is None or self._collector.done():
+            self._collector = asyncio.create_task(self._collect())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self._max_wait
+            while len(batch) < self._max_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Пачка обрабатывается в фоне, чтобы сбор следующей не ждал LLM
+            flush = asyncio.create_task(self._flush(batch))
+            self._flushes.add(flush)
+            flush.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch):
+        try:
+            results = await self._handler([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+SEARCH_BATCH_MAX = 16
+SEARCH_BATCH_WAIT = 0.02
+
+async def _answer_document_queries(queries: list[str]) -> list[str]:
+    """Ищет ответы на пачку вопросов: эмбеддинги считаются одним запросом"""
+    embeddings = await Settings.embed_model.aget_text_embedding_batch(queries)
+
+    async def answer(query: str, embedding: list[float]) -> str:
+        query_bundle = QueryBundle(query_str=query, embedding=embedding)
+        nodes = await query_engine.aretrieve(query_bundle)
+        return str(await query_engine.asynthesize(query_bundle, nodes))
+
+    results = await asyncio.gather(
+        *(answer(query, embedding) for query, embedding in zip(queries, embeddings)),
+        return_exceptions=True,
+    )
+    return [
+        f"Ошибка поиска в документах: {result}" if isinstance(result, Exception) else result
+        for result in results
+    ]
+
+search_batcher = MicroBatcher(
+    _answer_document_queries, max_size=SEARCH_BATCH_MAX, max_wait=SEARCH_BATCH_WAIT
+)
+
 async def search_documents(query: str) -> str:
     """Полезна для ответов на вопросы о документах компании."""
     if query_engine:
         try:
-            response = await query_engine.aquery(query)
-            return str(response)
+            return await search_batcher.submit(query)
         except Exception as e:
             return f"Ошибка поиска в документах: {e}"
     return "Система поиска в документах недоступна."
 
+# Предел размера целой степени в битах: 9**9**9**9 не должен занимать цикл событий
+_CALC_MAX_POWER_BITS = 4096
+
+def _bounded_pow(base, exponent):
+    """Возведение в степень, отклоняющее слишком большие целые результаты"""
+    if (isinstance(base, int) and isinstance(exponent, int) and exponent > 0 and abs(base) > 1
+            and exponent * abs(base).bit_length() > _CALC_MAX_POWER_BITS):
+        raise ValueError("слишком большая степень")
+    return base ** exponent
+
+# Предел точности округления: round(5, -10**7) считал бы 10**(10**7) десятки секунд
+_CALC_MAX_ROUND_DIGITS = 100
+
+def _bounded_round(number, ndigits=None):
+    """round, отклоняющий слишком большое по модулю число знаков"""
+    if isinstance(ndigits, int) and abs(ndigits) > _CALC_MAX_ROUND_DIGITS:
+        raise ValueError("слишком большое число знаков округления")
+    return round(number, ndigits)
+
+class _BoundedPow(ast.NodeTransformer):
+    """Заменяет оператор ** вызовом _bounded_pow"""
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Pow):
+            return ast.copy_location(
+                ast.Call(func=ast.Name(id='_pow', ctx=ast.Load()), args=[node.left, node.right], keywords=[]),
+                node,
+            )
+        return node
+
+_CALC_FUNCTIONS = ('abs', 'min', 'max', 'round', 'sum')
+_CALC_GLOBALS = {
+    '__builtins__': {}, '_pow': _bounded_pow,
+    **{name: getattr(builtins, name) for name in _CALC_FUNCTIONS},
+    'round': _bounded_round,
+}
+# Сдвиги и битовые операции не разрешены: 1 << 10**9 так же опасен, как большая степень
+_CALC_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Load, ast.keyword,
+    ast.Constant, ast.Tuple, ast.List, ast.Compare, ast.cmpop,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.UAdd, ast.USub,
+)
+
+@lru_cache(maxsize=512)
+def _compile_expression(expression: str):
+    """Проверяет и компилирует выражение; результат кэшируется по тексту выражения"""
+    tree = ast.parse(expression, mode="eval")
+    for node in ast.walk(tree):
+        if not isinstance(node, _CALC_NODES):
+            raise ValueError(f"недопустимая конструкция {type(node).__name__}")
+        if isinstance(node, ast.Name) and node.id not in _CALC_FUNCTIONS:
+            raise ValueError(f"недопустимое имя {node.id}")
+        if isinstance(node, ast.Call) and not isinstance(node.func, ast.Name):
+            raise ValueError("допускаются только вызовы abs, min, max, round, sum")
+        if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise ValueError("допускаются только числа")
+        # Списки - только аргументы функций: [1] * 10**9 создал бы огромный список
+        if isinstance(node, (ast.List, ast.Tuple)) and any(
+                isinstance(item, (ast.List, ast.Tuple)) for item in node.elts):
+            raise ValueError("вложенные списки не допускаются")
+        if isinstance(node, ast.BinOp) and any(
+                isinstance(operand, (ast.List, ast.Tuple)) for operand in (node.left, node.right)):
+            raise ValueError("операции над списками не допускаются")
+    tree = ast.fix_missing_locations(_BoundedPow().visit(tree))
+    return compile(tree, "<calc>", "eval")
+
 def calculate(expression: str) -> str:
     """Выполняет математические вычисления."""
     try:
-        allowed_names = {
-            k: v for k, v in __builtins__.items() if k in ['abs', 'min', 'max', 'round', 'sum']
-        }
-        allowed_names.update({'__builtins__': {}})
-        
-        result = eval(expression, allowed_names)
+        result = eval(_compile_expression(expression), _CALC_GLOBALS)
         return f"Результат: {result}"
     except Exception as e:
         return f"Ошибка вычисления: {e}"
 
-expert_agent = FunctionAgent(
-    tools=[search_documents, calculate],
-    llm=OpenAI(model="gpt-4o-mini"),
-    system_prompt=f"""You are an expert at AI Solutions Corp. You know everything about our products and services.
+# Системный промпт собирается один раз: постоянный префикс каждого запроса к LLM
+EXPERT_SYSTEM_PROMPT = f"""You are an expert at AI Solutions Corp. You know everything about our products and services.
 
 Company information:
 {COMPANY_DATA}
@@ -90,9 +257,93 @@ You can:
 2. Perform mathematical calculations
 3. Search for information in company documents
 
-Answer in a professional and detailed manner. Always provide specific details about products, including prices and specifications.""",
+Answer in a professional and detailed manner. Always provide specific details about products, including prices and specifications."""
+
+expert_agent = FunctionAgent(
+    tools=[search_documents, calculate],
+    llm=OpenAI(model="gpt-4o-mini"),
+    system_prompt=EXPERT_SYSTEM_PROMPT,
 )
 
+BATCH_MAX = 8
+BATCH_WAIT = 0.05
+
+# В заголовке ответа случайный токен пачки: текст вопросов не может подделать разделитель
+BATCH_PROMPT_TMPL = """Answer each of the following independent queries.
+Start every answer with a separate line "### Answer {token}-N", where N is the query number, and do not write anything before the first answer.
+
+"""
+
+def _answer_header_re(token: str) -> re.Pattern:
+    return re.compile(rf"^###\s*Answer\s+{token}-(\d+)\s*$", re.MULTILINE)
+
+def split_batch_answers(text: str, count: int, token: str) -> list[str] | None:
+    """Разбирает ответ на пачку запросов; None, если модель нарушила формат"""
+    parts = _answer_header_re(token).split(text)
+    numbers = [int(n) for n in parts[1::2]]
+    if numbers != list(range(1, count + 1)):
+        return None
+    return [answer.strip() for answer in parts[2::2]]
+
+async def run_expert(query: str, on_delta=None) -> str:
+    """Запускает агента; если задан on_delta, передает в него фрагменты ответа по мере генерации"""
+    handler = expert_agent.run(query)
+    if on_delta:
+        async for event in handler.stream_events():
+            if isinstance(event, AgentStream) and event.delta:
+                on_delta(event.delta)
+    result = await handler
+    return result.response.content or ""
+
+async def _answer_context_queries(requests: list[tuple]) -> list[str | Exception]:
+    """Отвечает на вопросы (query, on_delta) одного контекста одним запуском агента"""
+    if len(requests) == 1:
+        query, on_delta = requests[0]
+        return [await run_expert(query, on_delta)]
+
+    # Ответ на пачку приходит целиком: потоковая передача возможна только для одиночного вопроса
+    queries = [query for query, _ in requests]
+    token = secrets.token_hex(4)
+    prompt = BATCH_PROMPT_TMPL.format(token=token) + "\n\n".join(
+        f"{number}) {query}" for number, query in enumerate(queries, 1)
+    )
+    answers = split_batch_answers(await run_expert(prompt), len(queries), token)
+    if answers is None:
+        logger.warning("Ответ на пачку не удалось разобрать, отвечаем на вопросы по одному")
+        # Ошибка одного вопроса не должна лишать ответа остальные
+        answers = await asyncio.gather(*(run_expert(query) for query in queries), return_exceptions=True)
+    return answers
+
+async def answer_queries(requests: list[tuple]) -> list[str | Exception]:
+    """Отвечает на пачку вопросов (context_id, query, on_delta).
+
+    В один запрос к LLM попадают только вопросы одного контекста: письма разных
+    клиентов с именами и реквизитами не смешиваются в общем промпте.
+    """
+    groups: dict[str, list[int]] = {}
+    for index, (context_id, _, _) in enumerate(requests):
+        groups.setdefault(context_id, []).append(index)
+
+    answers: list[str | Exception | None] = [None] * len(requests)
+
+    async def answer_group(indexes: list[int]):
+        try:
+            group_answers = await _answer_context_queries([requests[i][1:] for i in indexes])
+        except Exception as e:
+            group_answers = [e] * len(indexes)
+        for index, answer in zip(indexes, group_answers):
+            answers[index] = answer
+
+    await asyncio.gather(*(answer_group(indexes) for indexes in groups.values()))
+    return answers
+
+expert_batcher = MicroBatcher(answer_queries, max_size=BATCH_MAX, max_wait=BATCH_WAIT)
+
+# Ответ передается частями артефакта; хранилище задач сохраняет задачу целиком после каждой части,
+# поэтому части собираются из целых строк и не короче STREAM_CHUNK_MIN_CHARS символов
+ANSWER_ARTIFACT_ID = "answer"
+STREAM_CHUNK_MIN_CHARS = 256
+
 class CompanyExpertExecutor(AgentExecutor):
     """A2A Executor для агента-эксперта компании"""
     
@@ -100,46 +351,76 @@ class CompanyExpertExecutor(AgentExecutor):
         """Выполняет задачи эксперта компании"""
         task_updater = TaskUpdater(event_queue, context.task_id, context.context_id)
         
+        # Закрытая очередь означает, что запрос уже отменен: публиковать события некуда
+        if event_queue.is_closed():
+            logger.warning("Event queue is closed, skipping task %s", context.task_id)
+            return
+
         try:
-            if event_queue.is_closed():
-                print("Warning: Event queue is closed, reopening...")
-                event_queue = EventQueue()
-                task_updater = TaskUpdater(event_queue, context.task_id, context.context_id)
-            
             task_updater.submit()
             task_updater.start_work()
             
             user_message = context.message.parts[0].root.text
-            print(f"Эксперт получил вопрос: {user_message}")
+            logger.debug("Эксперт получил вопрос: %s", user_message)
             
+            pending_chunks: list[str] = []
+            streamed = False
+
+            def send_chunk(last_chunk: bool):
+                nonlocal streamed
+                text = "".join(pending_chunks)
+                event_queue.enqueue_event(
+                    TaskArtifactUpdateEvent(
+                        taskId=context.task_id,
+                        contextId=context.context_id,
+                        artifact=Artifact(
+                            artifactId=ANSWER_ARTIFACT_ID,
+                            parts=[TextPart(text=text)] if text else [],
+                        ),
+                        append=streamed,
+                        lastChunk=last_chunk,
+                    )
+                )
+                streamed = True
+                pending_chunks.clear()
+
+            def forward_delta(delta: str):
+                pending_chunks.append(delta)
+                if "\n" in delta and sum(map(len, pending_chunks)) >= STREAM_CHUNK_MIN_CHARS:
+                    send_chunk(last_chunk=False)
+
             try:
-                response = await expert_agent.run(user_message)
-                final_text_response = str(response)
+                final_text_response = await expert_batcher.submit(
+                    (context.context_id, user_message, forward_delta))
             except Exception as agent_error:
-                print(f"Ошибка агента LlamaIndex: {agent_error}")
+                logger.warning("Ошибка агента LlamaIndex: %s", agent_error)
                 final_text_response = f"Получен вопрос: {user_message}\n\n{COMPANY_DATA}"
             
-            print(f"Эксперт отвечает: {final_text_response[:200]}...")
+            if streamed or pending_chunks:
+                send_chunk(last_chunk=True)
+            
+            logger.debug("Эксперт отвечает: %s", final_text_response)
             
             task_updater.update_status(
                 TaskState.completed,
                 message=task_updater.new_agent_message(
                     parts=[TextPart(text=final_text_response)]
                 ),
+                final=True,
             )
             
         except Exception as e:
-            print(f"Ошибка в CompanyExpertExecutor: {e}")
+            logger.exception("Ошибка в CompanyExpertExecutor: %s", e)
             try:
-                task_updater = TaskUpdater(event_queue, context.task_id, context.context_id)
                 task_updater.update_status(
                     TaskState.failed,
                     message=task_updater.new_agent_message(
-                        parts=[TextPart(text=f"Ошибка при обработке запроса: {str(e)}")]
+                        parts=[TextPart(text=f"Ошибка при обработке запроса: {type(e).__name__}")]
                     ),
+                    final=True,
                 )
             except Exception as update_error:
-                print(f"Критическая ошибка при обновлении статуса: {update_error}")
+                logger.error("Критическая ошибка при обновлении статуса: %s", update_error)
         
     async def cancel(self, context: RequestContext, event_queue: EventQueue):
         """Отменяет выполнение задачи"""
@@ -147,24 +428,18 @@ class CompanyExpertExecutor(AgentExecutor):
             task_updater = TaskUpdater(event_queue, context.task_id, context.context_id)
             task_updater.update_status(TaskState.canceled)
         except Exception as e:
-            print(f"Ошибка при отмене задачи: {e}")
+            logger.error("Ошибка при отмене задачи: %s", e)
 
-@click.command()
-@click.option('--host', default='localhost', help='Host для сервера')
-@click.option('--port', default=10007, help='Порт для сервера')
-def main(host: str, port: int):
-    """Запускает A2A сервер эксперта компании"""
-    
-    agent_executor = CompanyExpertExecutor()
-    
-    agent_card = AgentCard(
+def build_agent_card(host: str, port: int) -> AgentCard:
+    """Описание агента-эксперта для A2A"""
+    return AgentCard(
         name='Company Expert Agent',
         description='Эксперт по продуктам и услугам AI Solutions Corp. Может отвечать на вопросы о компании, выполнять расчеты и искать в документах.',
         url=f'http://{host}:{port}/',
         version='1.0.0',
         defaultInputModes=['text'],
         defaultOutputModes=['text'],
-        capabilities=AgentCapabilities(streaming=False),
+        capabilities=AgentCapabilities(streaming=True),
         authentication={"schemes": ["basic"]},
         skills=[
             AgentSkill(
@@ -187,10 +462,22 @@ def main(host: str, port: int):
             )
         ],
     )
-    
+
+def build_app(agent_card: AgentCard | None = None) -> Starlette:
+    """Собирает A2A приложение эксперта.
+
+    Без аргументов (так приложение создают воркеры gunicorn) адрес берется
+    из переменных окружения EXPERT_HOST и EXPERT_PORT.
+    """
+    if agent_card is None:
+        configure_logging("expert_agent", os.getenv("LOG_LEVEL", "info"))
+        agent_card = build_agent_card(
+            os.getenv("EXPERT_HOST", "localhost"), int(os.getenv("EXPERT_PORT", "10007"))
+        )
+
     request_handler = DefaultRequestHandler(
-        agent_executor=agent_executor,
-        task_store=InMemoryTaskStore()
+        agent_executor=CompanyExpertExecutor(),
+        task_store=create_task_store()
     )
     
     # Создаем A2A приложение
@@ -198,13 +485,30 @@ def main(host: str, port: int):
         agent_card=agent_card,
         http_handler=request_handler
     )
+    return a2a_app.build(routes=[agent_card_route(agent_card)], lifespan=lifespan)
+
+@click.command()
+@click.option('--host', default='localhost', help='Host для сервера')
+@click.option('--port', default=10007, help='Порт для сервера')
+@click.option('--workers', default=1, help='Количество процессов; больше одного - запуск через gunicorn')
+@click.option('--log-level', default='info', help='Уровень логирования агента (debug, info, warning, error)')
+def main(host: str, port: int, workers: int, log_level: str):
+    """Запускает A2A сервер эксперта компании"""
+    
+    configure_logging("expert_agent", log_level)
+    agent_card = build_agent_card(host, port)
     
     print(f"Запуск Company Expert Agent на {host}:{port}")
     print("Доступные навыки:")
     for skill in agent_card.skills:
         print(f"  - {skill.name}: {skill.description}")
     
-    uvicorn.run(a2a_app.build(), host=host, port=port, log_level="info")
+    if workers > 1:
+        run_workers("expert_agent:build_app()", host, port, workers,
+                    {"EXPERT_HOST": host, "EXPERT_PORT": str(port), "LOG_LEVEL": log_level})
+    else:
+        uvicorn.run(build_app(agent_card), host=host, port=port, log_level="warning",
+                    loop="uvloop", http="httptools")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
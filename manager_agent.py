@@ -1,34 +1,143 @@
 import asyncio
+import contextlib
+import hashlib
+import logging
 import os
-import uuid
+import re
 import httpx
 import click
 import uvicorn
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from pydantic_ai import Agent
 from pydantic import BaseModel, Field
+from ulid import ULID
 
 from a2a.types import (
     AgentCard, AgentCapabilities, AgentSkill, TaskState, TextPart,
-    SendMessageRequest, MessageSendParams, GetTaskRequest, TaskQueryParams
+    SendMessageRequest, MessageSendParams, GetTaskRequest, TaskQueryParams, Task,
+    SendStreamingMessageRequest, TaskArtifactUpdateEvent, TaskStatusUpdateEvent
 )
 from a2a.server.request_handlers import DefaultRequestHandler
-from a2a.server.tasks import InMemoryTaskStore, TaskUpdater
+from a2a.server.tasks import TaskUpdater
 from a2a.server.apps import A2AStarletteApplication
 from a2a.server.agent_execution import AgentExecutor
 from a2a.server.agent_execution.context import RequestContext
 from a2a.server.events import EventQueue
-from a2a.client import A2AClient
+from a2a.client import A2ACardResolver, A2AClient
 from a2a.types import GetTaskSuccessResponse
+from starlette.applications import Starlette
+
+from redis_task_store import create_task_store
+from server_utils import agent_card_route, configure_logging, run_workers
 
 load_dotenv()
 
+logger = logging.getLogger("manager_agent")
+
 if not os.getenv("MISTRAL_API_KEY"):
     raise ValueError("MISTRAL_API_KEY not found. Please check your .env file.")
 
 # URL эксперта компании
 EXPERT_AGENT_URL = "http://localhost:10007/"
 
+# Опрос задачи эксперта: быстрые ответы забираем сразу, медленные - не чаще раза в 0.5 с
+POLL_INITIAL_DELAY = 0.02
+POLL_BACKOFF = 1.7
+POLL_MAX_DELAY = 0.5
+EXPERT_TIMEOUT = 25.0
+
+TERMINAL_STATES = (
+    TaskState.completed, TaskState.failed, TaskState.canceled, TaskState.rejected
+)
+
+# Кэш ответов эксперта: одинаковые по сути письма не отправляются эксперту повторно
+EXPERT_CACHE: TTLCache = TTLCache(maxsize=1024, ttl=3600)
+_expert_cache_lock = asyncio.Lock()
+
+# Подписью считается только строка, состоящая из одной прощальной фразы:
+# "Thank you for the brochure. We need..." - уже часть запроса
+_SIGNATURE_RE = re.compile(
+    r"^\s*(?:thank you|thanks|best regards|kind regards|regards|sincerely)\s*[,.!]?\s*$",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+
+# Подпись ищется только в последних строках письма, иначе "Thank you..." в начале обрезало бы все письмо
+SIGNATURE_TAIL_LINES = 6
+# Слишком короткие письма не кэшируются: разные клиенты могли бы получить один ключ
+EXPERT_CACHE_MIN_LENGTH = 40
+
+
+def expert_cache_key(client_email: str) -> str | None:
+    """Ключ кэша: хэш письма без подписи, регистра и лишних пробелов; None, если письмо не кэшируется"""
+    lines = client_email.rstrip().splitlines()
+    tail_start = max(len(lines) - SIGNATURE_TAIL_LINES, 0)
+    tail = "\n".join(lines[tail_start:])
+    matches = list(_SIGNATURE_RE.finditer(tail))
+    if matches:
+        lines = lines[:tail_start] + tail[:matches[-1].start()].splitlines()
+    normalized = " ".join(" ".join(lines).lower().split())
+    if len(normalized) < EXPERT_CACHE_MIN_LENGTH:
+        return None
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+# Общий HTTP клиент: соединения с экспертом переиспользуются между запросами
+HTTPX_CLIENT = httpx.AsyncClient(
+    timeout=30.0,
+    limits=httpx.Limits(max_keepalive_connections=64, max_connections=128),
+    http2=True,
+)
+
+# A2A клиент эксперта создается при первом обращении (карточка агента запрашивается один раз)
+EXPERT_AGENT_CARD: AgentCard | None = None
+EXPERT_A2A_CLIENT: A2AClient | None = None
+_expert_client_lock = asyncio.Lock()
+
+# Эксперт пишет эту строку после сводки о продуктах: дальше менеджер его не ждет
+EXPERT_SUMMARY_READY = "--- PRODUCT SUMMARY READY ---"
+
+
+class ExpertError(Exception):
+    """Эксперт не смог дать ответ; текст исключения передается менеджеру"""
+
+
+_background_tasks: set[asyncio.Task] = set()
+
+
+async def _drain_stream(events):
+    """Дочитывает поток событий эксперта до конца и закрывает его"""
+    try:
+        async for _ in events:
+            pass
+    except Exception as e:
+        logger.warning("Ошибка при дочитывании потока эксперта: %s", e)
+    finally:
+        await events.aclose()
+
+
+async def get_expert_client() -> A2AClient:
+    """Возвращает закэшированный A2A клиент эксперта"""
+    global EXPERT_AGENT_CARD, EXPERT_A2A_CLIENT
+    if EXPERT_A2A_CLIENT is None:
+        async with _expert_client_lock:
+            if EXPERT_A2A_CLIENT is None:
+                EXPERT_AGENT_CARD = await A2ACardResolver(
+                    HTTPX_CLIENT, EXPERT_AGENT_URL
+                ).get_agent_card()
+                EXPERT_A2A_CLIENT = A2AClient(
+                    HTTPX_CLIENT, agent_card=EXPERT_AGENT_CARD)
+    return EXPERT_A2A_CLIENT
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    """Закрывает общий HTTP клиент при остановке сервера"""
+    yield
+    for task in list(_background_tasks):
+        task.cancel()
+    await HTTPX_CLIENT.aclose()
+
 
 class ManagerResponse(BaseModel):
     """Manager Response Structure."""
@@ -40,6 +149,14 @@ class ManagerResponse(BaseModel):
     Should recognise the client's needs, briefly explain how the requested products can help, and suggest the next step (planning demo).""")
 
 
+class ClientDetails(BaseModel):
+    """Client details extracted from the incoming email."""
+    client_name: str = Field(
+        description="The name of the client to contact, e.g. 'Sarah Jones'.")
+    response_subject: str = Field(
+        description="A suitable title for the response email, e.g. 'Re: Inquiry about AI Solutions'.")
+
+
 # Создаем агента с правильной конфигурацией
 manager_agent = Agent(
     model='mistral:mistral-large-latest',
@@ -48,6 +165,54 @@ manager_agent = Agent(
     Analyse incoming customer emails and create personalised responses in the specified format."""
 )
 
+# Быстрый предварительный разбор письма, выполняется параллельно с консультацией эксперта
+preanalysis_agent = Agent(
+    model='mistral:mistral-large-latest',
+    result_type=ClientDetails,
+    system_prompt="""You are an assistant to a sales manager.
+    Extract the client's name from incoming customer emails and suggest a subject for the reply."""
+)
+
+# Шаблоны запросов: статичные инструкции идут первыми, чтобы у LLM-провайдера
+# срабатывал кэш общего префикса, а данные конкретного письма подставляются в конце
+MANAGER_PROMPT_TMPL = """Your task is to:
+1. address the client by name
+2. Recognise their specific problems
+3. Briefly explain how our products solve their problems using information from an expert
+4. Enthusiastically offer to schedule a demonstration
+5. Create a response in the required structured format
+6. Dont write Best regards and Sales Manager in the end of email.
+
+Client details extracted from the email:
+{details_info}
+
+Information from the company expert:
+{expert_info}
+
+You have received the following email from a potential client:
+{client_email}
+"""
+
+EXPERT_QUERY_TMPL = f"""Analyse the customer email below and provide details of our products that can help.
+Especially interested in information about Document Analyzer and Vision AI. Don't write a return email, just tell us about our products.
+When the product summary is complete, write the line "{EXPERT_SUMMARY_READY}" on its own.
+
+Customer email:
+{{client_email}}
+"""
+
+FALLBACK_BODY_TMPL = """Thank you for your interest in our AI solutions!
+
+I understand that Global Retail Express is facing challenges in document processing and inventory management.
+
+Based on information from our expert:
+{expert_summary}...
+
+Our Document Analyzer and Vision AI solutions are perfect for your challenges.
+Let's schedule a demo to show you how they can help your business.
+
+When would be a good time for you to give an online presentation?"""
+
 
 class ManagerAgentExecutor(AgentExecutor):
     """A2A Executor для агента-менеджера"""
@@ -57,60 +222,52 @@ class ManagerAgentExecutor(AgentExecutor):
         task_updater = TaskUpdater(
             event_queue, context.task_id, context.context_id)
 
-        try:
-            if event_queue.is_closed():
-                print("Warning: Event queue is closed, creating new one...")
-                event_queue = EventQueue()
-                task_updater = TaskUpdater(
-                    event_queue, context.task_id, context.context_id)
+        # Закрытая очередь означает, что запрос уже отменен: публиковать события некуда
+        if event_queue.is_closed():
+            logger.warning("Event queue is closed, skipping task %s", context.task_id)
+            return
 
+        try:
             task_updater.submit()
             task_updater.start_work()
 
             client_email = context.message.parts[0].root.text
-            print(f"Менеджер получил письмо клиента: {client_email[:100]}...")
-
-            expert_info = await self._consult_expert(client_email)
-
-            manager_prompt = f"""
-            Information from the company expert:
-            {expert_info}
-
-            You have received the following email from a potential client:
-            {client_email}
-
-            Your task is to:
-            1. address the client by name
-            2. Recognise their specific problems
-            3. Briefly explain how our products solve their problems using information from an expert
-            4. Enthusiastically offer to schedule a demonstration
-            5. Create a response in the required structured format
-            6. Dont write Best regards and Sales Manager in the end of email.
-            """
+            logger.debug("Менеджер получил письмо клиента: %s", client_email)
+
+            async with asyncio.TaskGroup() as tg:
+                expert_task = tg.create_task(self._consult_expert(client_email))
+                details_task = tg.create_task(
+                    self._extract_client_details(client_email))
+            expert_info = expert_task.result()
+            client_details = details_task.result()
+
+            if client_details:
+                details_info = (f"Client name: {client_details.client_name}\n"
+                                f"Suggested subject: {client_details.response_subject}")
+            else:
+                details_info = "Not available"
+
+            manager_prompt = MANAGER_PROMPT_TMPL.format_map({
+                'details_info': details_info,
+                'expert_info': expert_info,
+                'client_email': client_email,
+            })
 
             try:
                 manager_result = await manager_agent.run(manager_prompt)
                 manager_reply = manager_result.output
 
-                print(
-                    f"Получен ответ от менеджера: {manager_reply.client_name}")
+                logger.info("Получен ответ от менеджера: %s", manager_reply.client_name)
 
             except Exception as ai_error:
-                print(f"Ошибка Pydantic AI: {ai_error}")
+                logger.warning("Ошибка Pydantic AI: %s", ai_error)
                 manager_reply = ManagerResponse(
-                    client_name="Sarah Jones",
-                    response_subject="Re: Inquiry about AI Solutions for E-commerce Logistics",
-                    response_body=f"""Thank you for your interest in our AI solutions!
-
-                        I understand that Global Retail Express is facing challenges in document processing and inventory management.
-
-                        Based on information from our expert:
-                        {expert_info[:500]}...
-
-                        Our Document Analyzer and Vision AI solutions are perfect for your challenges. 
-                        Let's schedule a demo to show you how they can help your business.
-
-                        When would be a good time for you to give an online presentation?"""
+                    client_name=client_details.client_name if client_details else "Sarah Jones",
+                    response_subject=(client_details.response_subject if client_details
+                                      else "Re: Inquiry about AI Solutions for E-commerce Logistics"),
+                    response_body=FALLBACK_BODY_TMPL.format_map({
+                        'expert_summary': expert_info[:500],
+                    })
                 )
 
             final_response = f"""To: {manager_reply.client_name}
@@ -126,109 +283,185 @@ class ManagerAgentExecutor(AgentExecutor):
                     Phone: +1-555-AI-SOLUTIONS
             """.strip()
 
-            print(f"Отправляем финальный ответ: {final_response[:200]}...")
+            logger.debug("Отправляем финальный ответ: %s", final_response)
 
             task_updater.update_status(
                 TaskState.completed,
                 message=task_updater.new_agent_message(
                     parts=[TextPart(text=final_response)]
                 ),
+                final=True,
             )
 
         except Exception as e:
-            print(f"Ошибка в ManagerAgentExecutor: {e}")
+            logger.exception("Ошибка в ManagerAgentExecutor: %s", e)
             try:
-                task_updater = TaskUpdater(
-                    event_queue, context.task_id, context.context_id)
                 task_updater.update_status(
                     TaskState.failed,
                     message=task_updater.new_agent_message(
                         parts=[
-                            TextPart(text=f"Ошибка при обработке письма: {str(e)}")]
+                            TextPart(text=f"Ошибка при обработке письма: {type(e).__name__}")]
                     ),
+                    final=True,
                 )
             except Exception as update_error:
-                print(
-                    f"Критическая ошибка при обновлении статуса: {update_error}")
+                logger.error("Критическая ошибка при обновлении статуса: %s", update_error)
+
+    async def _extract_client_details(self, client_email: str) -> ClientDetails | None:
+        """Извлекает имя клиента и тему ответа; None, если разбор не удался"""
+        try:
+            result = await preanalysis_agent.run(client_email)
+            logger.debug("Предварительный разбор письма: %s", result.output.client_name)
+            return result.output
+        except Exception as e:
+            logger.warning("Ошибка предварительного разбора письма: %s", e)
+            return None
 
     async def _consult_expert(self, client_email: str) -> str:
         """Консультируется с экспертом компании через A2A"""
+        cache_key = expert_cache_key(client_email)
+        cached_response = None
+        if cache_key is not None:
+            async with _expert_cache_lock:
+                cached_response = EXPERT_CACHE.get(cache_key)
+        if cached_response is not None:
+            logger.debug("Ответ эксперта взят из кэша")
+            return cached_response
+
         try:
             # Формируем вопрос для эксперта
-            expert_query = f"""
-            Analyse this customer email and provide details of our products that can help:
-            
-            {client_email}
-            
-            Especially interested in information about Document Analyzer and Vision AI. Don't write a return email, just tell us about our products.        
-            """
-
-            print("Отправляем запрос эксперту...")
-
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                try:
-                    expert_agent = await A2AClient.get_client_from_agent_card_url(
-                        client, EXPERT_AGENT_URL
-                    )
-
-                    send_request = SendMessageRequest(
-                        params=MessageSendParams(
-                            message={
-                                'messageId': str(uuid.uuid4()),
-                                'role': 'user',
-                                'parts': [{'type': 'text', 'text': expert_query}],
-                            }
-                        )
-                    )
-
-                    response = await expert_agent.send_message(send_request)
-
-                    if hasattr(response.root, "result"):
-                        expert_task = response.root.result
-                        print(f"Создана задача для эксперта: {expert_task.id}")
-
-                        max_attempts = 20
-                        attempts = 0
-
-                        while (expert_task.status.state not in (
-                            TaskState.completed, TaskState.failed, TaskState.canceled, TaskState.rejected
-                        ) and attempts < max_attempts):
-                            await asyncio.sleep(0.5)
-                            attempts += 1
-
-                            try:
-                                get_resp = await expert_agent.get_task(
-                                    GetTaskRequest(
-                                        params=TaskQueryParams(id=expert_task.id))
-                                )
-                                if isinstance(get_resp.root, GetTaskSuccessResponse):
-                                    expert_task = get_resp.root.result
-                                    print(
-                                        f"Статус задачи эксперта: {expert_task.status.state}")
-                                else:
-                                    break
-                            except Exception as get_error:
-                                print(
-                                    f"Ошибка при получении статуса задачи: {get_error}")
-                                break
-
-                        if expert_task.status.state == TaskState.completed and expert_task.status.message:
-                            expert_response = expert_task.status.message.parts[0].root.text
-                            print(
-                                f"Получен ответ от эксперта: {expert_response[:100]}...")
-                            return expert_response
-                        else:
-                            return f"Не удалось получить ответ от эксперта. Статус: {expert_task.status.state}"
-                    else:
-                        return "Ошибка при создании задачи для эксперта."
-
-                except httpx.ConnectError as conn_error:
-                    print(f"Ошибка подключения к эксперту: {conn_error}")
-                    return "Эксперт временно недоступен. Используем базовую информацию о продуктах."
+            expert_query = EXPERT_QUERY_TMPL.format_map({'client_email': client_email})
+
+            logger.debug("Отправляем запрос эксперту")
+
+            try:
+                expert_agent = await get_expert_client()
+
+                message = {
+                    'messageId': str(ULID()),
+                    'role': 'user',
+                    'parts': [{'type': 'text', 'text': expert_query}],
+                }
+
+                if EXPERT_AGENT_CARD.capabilities.streaming:
+                    ask_expert = self._stream_expert_response(expert_agent, message)
+                else:
+                    ask_expert = self._poll_expert_response(expert_agent, message)
+
+                expert_response = await asyncio.wait_for(
+                    ask_expert, timeout=EXPERT_TIMEOUT)
+
+            except ExpertError as expert_error:
+                return expert_error.args[0]
+            except asyncio.TimeoutError:
+                return f"Эксперт не ответил за {EXPERT_TIMEOUT} секунд."
+            except httpx.ConnectError as conn_error:
+                logger.warning("Ошибка подключения к эксперту: %s", conn_error)
+                return "Эксперт временно недоступен. Используем базовую информацию о продуктах."
+
+            expert_response = expert_response.partition(EXPERT_SUMMARY_READY)[0].strip()
+            logger.debug("Получен ответ от эксперта: %s", expert_response)
+            if cache_key is not None:
+                async with _expert_cache_lock:
+                    EXPERT_CACHE[cache_key] = expert_response
+            return expert_response
 
         except Exception as e:
-            print(f"Ошибка при консультации с экспертом: {e}")
-            return f"Ошибка связи с экспертом: {str(e)}. Используем базовую информацию."
+            logger.exception("Ошибка при консультации с экспертом: %s", e)
+            return f"Ошибка связи с экспертом: {type(e).__name__}. Используем базовую информацию."
+
+    async def _stream_expert_response(self, expert_agent: A2AClient, message: dict) -> str:
+        """Получает ответ эксперта потоком и возвращается, как только сводка готова"""
+        request = SendStreamingMessageRequest(
+            params=MessageSendParams(message=message))
+        chunks: list[str] = []
+        answer: str | None = None
+        final_state: TaskState | None = None
+
+        events = expert_agent.send_message_streaming(request)
+        handed_off = False
+        try:
+            async for event in events:
+                if not hasattr(event.root, "result"):
+                    raise ExpertError("Ошибка при создании задачи для эксперта.")
+                update = event.root.result
+                if isinstance(update, TaskArtifactUpdateEvent):
+                    # Эксперт передает ответ частями артефакта
+                    chunks.extend(part.root.text for part in update.artifact.parts)
+                    streamed = "".join(chunks)
+                    if EXPERT_SUMMARY_READY in streamed:
+                        logger.debug("Сводка эксперта готова, не ждем окончания ответа")
+                        # Поток дочитывается в фоне: разрыв соединения отменил бы задачу эксперта
+                        handed_off = True
+                        drain = asyncio.create_task(_drain_stream(events))
+                        _background_tasks.add(drain)
+                        drain.add_done_callback(_background_tasks.discard)
+                        return streamed
+                    continue
+                if not isinstance(update, TaskStatusUpdateEvent):
+                    continue
+
+                state = update.status.state
+                status_message = update.status.message
+                if state == TaskState.submitted:
+                    logger.debug("Создана задача для эксперта: %s", update.taskId)
+                elif state in TERMINAL_STATES:
+                    # Сервер завершает поток сразу после финального события: поток дочитывается,
+                    # иначе эксперт получит разрыв соединения посреди обработки задачи
+                    final_state = state
+                    if state == TaskState.completed and status_message:
+                        answer = status_message.parts[0].root.text
+        finally:
+            if not handed_off:
+                await events.aclose()
+
+        if answer is not None:
+            return answer
+        if final_state is not None:
+            raise ExpertError(
+                f"Не удалось получить ответ от эксперта. Статус: {final_state}")
+        raise ExpertError("Поток ответа эксперта завершился без результата.")
+
+    async def _poll_expert_response(self, expert_agent: A2AClient, message: dict) -> str:
+        """Отправляет вопрос эксперту и опрашивает задачу до ее завершения"""
+        response = await expert_agent.send_message(
+            SendMessageRequest(params=MessageSendParams(message=message)))
+
+        if not hasattr(response.root, "result"):
+            raise ExpertError("Ошибка при создании задачи для эксперта.")
+
+        expert_task = response.root.result
+        logger.debug("Создана задача для эксперта: %s", expert_task.id)
+
+        expert_task = await self._wait_for_expert_task(expert_agent, expert_task)
+
+        if expert_task.status.state == TaskState.completed and expert_task.status.message:
+            return expert_task.status.message.parts[0].root.text
+        raise ExpertError(
+            f"Не удалось получить ответ от эксперта. Статус: {expert_task.status.state}")
+
+    async def _wait_for_expert_task(self, expert_agent: A2AClient, expert_task: Task) -> Task:
+        """Опрашивает статус задачи эксперта с экспоненциально растущей паузой"""
+        delay = POLL_INITIAL_DELAY
+
+        while expert_task.status.state not in TERMINAL_STATES:
+            await asyncio.sleep(delay)
+            delay = min(delay * POLL_BACKOFF, POLL_MAX_DELAY)
+
+            try:
+                get_resp = await expert_agent.get_task(
+                    GetTaskRequest(params=TaskQueryParams(id=expert_task.id))
+                )
+                if isinstance(get_resp.root, GetTaskSuccessResponse):
+                    expert_task = get_resp.root.result
+                    logger.debug("Статус задачи эксперта: %s", expert_task.status.state)
+                else:
+                    break
+            except Exception as get_error:
+                logger.warning("Ошибка при получении статуса задачи: %s", get_error)
+                break
+
+        return expert_task
 
     async def cancel(self, context: RequestContext, event_queue: EventQueue):
         """Отменяет выполнение задачи"""
@@ -237,25 +470,19 @@ class ManagerAgentExecutor(AgentExecutor):
                 event_queue, context.task_id, context.context_id)
             task_updater.update_status(TaskState.canceled)
         except Exception as e:
-            print(f"Ошибка при отмене задачи: {e}")
-
-
-@click.command()
-@click.option('--host', default='localhost', help='Host для сервера')
-@click.option('--port', default=10008, help='Порт для сервера')
-def main(host: str, port: int):
-    """Запускает A2A сервер менеджера"""
+            logger.error("Ошибка при отмене задачи: %s", e)
 
-    agent_executor = ManagerAgentExecutor()
 
-    agent_card = AgentCard(
+def build_agent_card(host: str, port: int) -> AgentCard:
+    """Описание агента-менеджера для A2A"""
+    return AgentCard(
         name='Sales Manager Agent',
         description='Профессиональный менеджер по продажам AI решений. Обрабатывает входящие запросы клиентов и генерирует персонализированные ответы.',
         url=f'http://{host}:{port}/',
         version='1.0.0',
         defaultInputModes=['text'],
         defaultOutputModes=['text'],
-        capabilities=AgentCapabilities(streaming=False),
+        capabilities=AgentCapabilities(streaming=True),
         authentication={"schemes": ["basic"]},
         skills=[
             AgentSkill(
@@ -273,15 +500,41 @@ def main(host: str, port: int):
         ],
     )
 
+
+def build_app(agent_card: AgentCard | None = None) -> Starlette:
+    """Собирает A2A приложение менеджера.
+
+    Без аргументов (так приложение создают воркеры gunicorn) адрес берется
+    из переменных окружения MANAGER_HOST и MANAGER_PORT.
+    """
+    if agent_card is None:
+        configure_logging("manager_agent", os.getenv("LOG_LEVEL", "info"))
+        agent_card = build_agent_card(
+            os.getenv("MANAGER_HOST", "localhost"), int(os.getenv("MANAGER_PORT", "10008"))
+        )
+
     request_handler = DefaultRequestHandler(
-        agent_executor=agent_executor,
-        task_store=InMemoryTaskStore()
+        agent_executor=ManagerAgentExecutor(),
+        task_store=create_task_store()
     )
 
     a2a_app = A2AStarletteApplication(
         agent_card=agent_card,
         http_handler=request_handler
     )
+    return a2a_app.build(routes=[agent_card_route(agent_card)], lifespan=lifespan)
+
+
+@click.command()
+@click.option('--host', default='localhost', help='Host для сервера')
+@click.option('--port', default=10008, help='Порт для сервера')
+@click.option('--workers', default=1, help='Количество процессов; больше одного - запуск через gunicorn')
+@click.option('--log-level', default='info', help='Уровень логирования агента (debug, info, warning, error)')
+def main(host: str, port: int, workers: int, log_level: str):
+    """Запускает A2A сервер менеджера"""
+
+    configure_logging("manager_agent", log_level)
+    agent_card = build_agent_card(host, port)
 
     print(f"Запуск Sales Manager Agent на {host}:{port}")
     print("Доступные навыки:")
@@ -289,7 +542,12 @@ def main(host: str, port: int):
         print(f"  - {skill.name}: {skill.description}")
     print(f"Ожидаем эксперта компании на {EXPERT_AGENT_URL}")
 
-    uvicorn.run(a2a_app.build(), host=host, port=port, log_level="info")
+    if workers > 1:
+        run_workers("manager_agent:build_app()", host, port, workers,
+                    {"MANAGER_HOST": host, "MANAGER_PORT": str(port), "LOG_LEVEL": log_level})
+    else:
+        uvicorn.run(build_app(agent_card), host=host, port=port, log_level="warning",
+                    loop="uvloop", http="httptools")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,44 @@
+import os
+
+import redis.asyncio as redis
+
+from a2a.server.tasks import InMemoryTaskStore, TaskStore
+from a2a.types import Task
+
+
+class RedisTaskStore(TaskStore):
+    """Хранилище задач A2A в Redis.
+
+    Задачи доступны всем процессам агента, поэтому его можно запускать
+    в нескольких воркерах или репликах за балансировщиком.
+    """
+
+    def __init__(self, url: str, ttl: int = 3600, prefix: str = "task:"):
+        self._redis = redis.Redis.from_url(url)
+        self._ttl = ttl
+        self._prefix = prefix
+
+    async def save(self, task: Task):
+        """Сохраняет задачу на ttl секунд"""
+        await self._redis.set(
+            self._prefix + task.id, task.model_dump_json(exclude_none=True), ex=self._ttl
+        )
+
+    async def get(self, task_id: str) -> Task | None:
+        """Возвращает задачу или None, если ее нет (или срок хранения истек)"""
+        data = await self._redis.get(self._prefix + task_id)
+        if data is None:
+            return None
+        return Task.model_validate_json(data)
+
+    async def delete(self, task_id: str):
+        """Удаляет задачу"""
+        await self._redis.delete(self._prefix + task_id)
+
+
+def create_task_store() -> TaskStore:
+    """Redis, если задан REDIS_URL, иначе хранилище в памяти процесса"""
+    redis_url = os.getenv("REDIS_URL")
+    if redis_url:
+        return RedisTaskStore(redis_url)
+    return InMemoryTaskStore()
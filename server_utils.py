@@ -0,0 +1,57 @@
+import logging
+import os
+import sys
+
+from a2a.types import AgentCard
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+
+
+def agent_card_route(agent_card: AgentCard, path: str = "/.well-known/agent.json") -> Route:
+    """Маршрут карточки агента, отдающий JSON, сериализованный один раз при запуске.
+
+    Передается в build(routes=[...]) и стоит перед маршрутом A2A по умолчанию,
+    поэтому запросы карточки не сериализуют модель заново.
+    """
+    body = agent_card.model_dump_json(exclude_none=True).encode()
+
+    async def get_agent_card(request: Request) -> Response:
+        return Response(content=body, media_type="application/json")
+
+    return Route(path, get_agent_card, methods=["GET"])
+
+
+def run_workers(app_factory: str, host: str, port: int, workers: int, env: dict[str, str]):
+    """Заменяет текущий процесс на gunicorn с несколькими воркерами uvicorn.
+
+    Каждый воркер сам импортирует модуль агента и вызывает app_factory,
+    поэтому адрес сервера передается ему через переменные окружения env.
+    """
+    if not os.getenv("REDIS_URL"):
+        logging.getLogger(__name__).warning(
+            "REDIS_URL не задан - задачи хранятся в памяти каждого воркера и не видны из других процессов")
+
+    os.environ.update(env)
+    # gunicorn запускается тем же интерпретатором: скрипт gunicorn может отсутствовать в PATH
+    os.execv(sys.executable, [
+        sys.executable, "-m", "gunicorn",
+        "--worker-class", "uvicorn_worker.UvicornWorker",
+        "--workers", str(workers),
+        "--bind", f"{host}:{port}",
+        "--chdir", os.path.dirname(os.path.abspath(__file__)),
+        app_factory,
+    ])
+
+
+def configure_logging(logger_name: str, level: str):
+    """Настраивает логирование агента; сообщения форматируются только если уровень включен.
+
+    Уровень задается только логгеру агента: корневой логгер (а с ним httpx, openai
+    и другие библиотеки) остается на WARNING, чтобы не писать строку на каждый запрос.
+    """
+    logging.basicConfig(
+        level=logging.WARNING,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    logging.getLogger(logger_name).setLevel(level.upper())
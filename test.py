@@ -1,11 +1,48 @@
 # test_a2a_system.py
 import asyncio
+import contextlib
+import hashlib
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import tempfile
+import time
 import httpx
+import orjson
+from aioconsole import ainput
+from collections import defaultdict, deque
+from pathlib import Path
+from urllib.parse import urlsplit
 from uuid import uuid4
 from pprint import pprint
-from a2a.client import A2AClient
+from a2a.client import A2ACardResolver, A2AClient, A2AClientHTTPError, A2AClientJSONError
 from a2a.types import SendMessageRequest, MessageSendParams, GetTaskRequest, TaskQueryParams, TaskState
-from a2a.types import GetTaskSuccessResponse
+from a2a.types import AgentCard, GetTaskSuccessResponse, SendStreamingMessageRequest, Task, TaskStatusUpdateEvent
+from a2a.types import Message, Part, Role, TextPart
+
+log = logging.getLogger("a2a_tests")
+
+# Вывод идет через очередь: сообщения пишет в консоль отдельный поток, не блокируя цикл событий
+LOG_QUEUE: queue.Queue = queue.Queue(-1)
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Направляет вывод тестов в консоль через очередь; возвращает запущенный обработчик очереди"""
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter("%(message)s"))
+    listener = logging.handlers.QueueListener(LOG_QUEUE, console)
+    listener.start()
+    log.addHandler(logging.handlers.QueueHandler(LOG_QUEUE))
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    return listener
+
+def flush_log():
+    """Дожидается вывода всех сообщений из очереди (перед ожиданием ввода пользователя)"""
+    LOG_QUEUE.join()
 
 # Тестовое письмо клиента
 CLIENT_EMAIL = """
@@ -27,297 +64,626 @@ Operations Manager
 Global Retail Express
 """
 
-async def wait_for_task_completion(client, task_id, max_wait_time=30):
-    """Ждет завершения задачи с таймаутом"""
-    attempts = 0
-    max_attempts = max_wait_time * 2  # проверяем каждые 0.5 секунд
+EXPERT_QUESTION = "Tell us in detail about Document Analyzer and Vision AI products. What can they do and how much do they cost?"
+CALCULATION_QUESTION = "What is 7 times 8? And also 15 plus 25?"
+
+BATCH_QUESTION = f"""Answer each of the following questions separately.
+Start each answer with a line "[Test answer N]", where N is the question number.
+
+1. {EXPERT_QUESTION}
+
+2. {CALCULATION_QUESTION}
+"""
+
+def user_message(text: str) -> Message:
+    """Сообщение пользователя без messageId; собирается один раз для каждого фиксированного вопроса"""
+    return Message(role=Role.user, parts=[Part(root=TextPart(text=text))], messageId="")
+
+EXPERT_MESSAGE = user_message(EXPERT_QUESTION)
+CALCULATION_MESSAGE = user_message(CALCULATION_QUESTION)
+BATCH_MESSAGE = user_message(BATCH_QUESTION)
+CLIENT_EMAIL_MESSAGE = user_message(CLIENT_EMAIL)
+
+def message_params(template: Message) -> MessageSendParams:
+    """Параметры отправки готового сообщения с новым messageId"""
+    return MessageSendParams(message=template.model_copy(update={"messageId": uuid4().hex}))
+
+# Один HTTP клиент на весь прогон: соединения с агентами переиспользуются между тестами
+# Таймауты в секундах: проверка доступности, ожидание ответа эксперта и менеджера
+HTTP_TIMEOUTS = {"health": 5.0, "rpc": 30.0, "manager_rpc": 60.0}
+HTTP_TIMEOUT = httpx.Timeout(connect=10.0, read=HTTP_TIMEOUTS["manager_rpc"], write=10.0, pool=10.0)
+# Соединения держатся открытыми весь прогон, пул с запасом покрывает параллельные тесты
+HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60.0)
+
+TERMINAL_STATES = (TaskState.completed, TaskState.failed, TaskState.canceled, TaskState.rejected)
+
+# A2A клиенты агентов; хранится задача, чтобы параллельные вызовы делили один запрос карточки
+_AGENT_CLIENTS: dict[tuple, asyncio.Task] = {}
+
+# Карточки агентов между запусками хранятся на диске
+AGENT_CARD_CACHE_DIR = Path.home() / ".cache" / "a2a_tests"
+AGENT_CARD_CACHE_TTL = 3600
+
+def _agent_card_cache_path(url) -> Path:
+    return AGENT_CARD_CACHE_DIR / f"{urlsplit(url).netloc.replace(':', '_')}.json"
+
+def load_cached_agent_card(url, ttl=AGENT_CARD_CACHE_TTL) -> AgentCard | None:
+    """Читает карточку агента из кэша на диске, если она моложе ttl секунд"""
+    path = _agent_card_cache_path(url)
+    try:
+        if time.time() - path.stat().st_mtime > ttl:
+            return None
+        return AgentCard.model_validate_json(path.read_bytes())
+    except (OSError, ValueError):
+        return None
+
+def store_agent_card(url, agent_card: AgentCard):
+    """Сохраняет карточку агента в кэш; файл заменяется атомарно"""
+    path = _agent_card_cache_path(url)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=path.parent, suffix=".tmp", delete=False) as tmp:
+            tmp.write(agent_card.model_dump_json(exclude_none=True))
+        os.replace(tmp.name, path)
+    except OSError as e:
+        log.warning("Не удалось сохранить карточку агента в кэш: %s", e)
+
+class OrjsonA2AClient(A2AClient):
+    """A2A клиент, кодирующий и разбирающий обычные JSON-RPC запросы через orjson.
+
+    Потоковые ответы по-прежнему разбирает a2a-sdk.
+    """
+
+    async def _send_request(self, rpc_request_payload, http_kwargs=None):
+        http_kwargs = dict(http_kwargs or {})
+        headers = {"Content-Type": "application/json", **http_kwargs.pop("headers", {})}
+        try:
+            response = await self.httpx_client.post(
+                self.url, content=orjson.dumps(rpc_request_payload), headers=headers, **http_kwargs
+            )
+            response.raise_for_status()
+            return orjson.loads(response.content)
+        except httpx.HTTPStatusError as e:
+            raise A2AClientHTTPError(e.response.status_code, str(e)) from e
+        except orjson.JSONDecodeError as e:
+            raise A2AClientJSONError(str(e)) from e
+        except httpx.RequestError as e:
+            raise A2AClientHTTPError(503, f'Network communication error: {e}') from e
+
+async def _connect_agent(httpx_client, url):
+    agent_card = load_cached_agent_card(url)
+    if agent_card is None:
+        agent_card = await A2ACardResolver(httpx_client, url).get_agent_card()
+        store_agent_card(url, agent_card)
+    return OrjsonA2AClient(httpx_client, agent_card=agent_card), agent_card
+
+def _forget_failed_client(key, task):
+    # Агент был недоступен - следующий вызов запросит карточку заново
+    if (task.cancelled() or task.exception() is not None) and _AGENT_CLIENTS.get(key) is task:
+        del _AGENT_CLIENTS[key]
+
+def prefetch_agent_client(httpx_client, url) -> asyncio.Task:
+    """Запускает получение клиента агента, если оно еще не начато, и не ждет результата"""
+    key = (httpx_client, url)
+    task = _AGENT_CLIENTS.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_connect_agent(httpx_client, url))
+        task.add_done_callback(lambda done: _forget_failed_client(key, done))
+        _AGENT_CLIENTS[key] = task
+    return task
+
+async def get_agent_client(httpx_client, url):
+    """Возвращает A2A клиент агента и его карточку, запрашивая карточку только один раз"""
+    return await prefetch_agent_client(httpx_client, url)
+
+POLL_INTERVAL = 0.5
+POLL_MIN_SAMPLES = 5
+POLL_QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9, 0.99)
+POLL_ERROR_BACKOFF = 1.0
+POLL_ERROR_BACKOFF_MAX = 30.0
+
+# Время выполнения завершенных задач по адресу агента; по нему выбираются моменты опроса
+TASK_LATENCIES: defaultdict[str, deque] = defaultdict(lambda: deque(maxlen=50))
+
+def poll_schedule(latencies) -> list[float]:
+    """Моменты опроса (в секундах от начала ожидания) по квантилям прошлых времен выполнения.
+
+    Пока замеров мало, расписания нет и задача опрашивается каждые POLL_INTERVAL секунд.
+    """
+    if len(latencies) < POLL_MIN_SAMPLES:
+        return []
+    ordered = sorted(latencies)
+    schedule = []
+    for q in POLL_QUANTILES:
+        point = ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+        if not schedule or point - schedule[-1] >= 0.05:
+            schedule.append(point)
+    return schedule
+
+async def _poll_task(client, task_id, started=None):
+    """Опрашивает задачу, пока она не перейдет в конечное состояние
+
+    started - момент отправки задачи (loop.time()), от него считается задержка
+    """
+    loop = asyncio.get_running_loop()
+    if started is None:
+        started = loop.time()
+    schedule = poll_schedule(TASK_LATENCIES[client.url])
+    last_poll = None
+    consecutive_errors = 0
     
-    while attempts < max_attempts:
+    while True:
         try:
+            poll_started = loop.time()
             get_resp = await client.get_task(
                 GetTaskRequest(params=TaskQueryParams(id=task_id))
             )
+            consecutive_errors = 0
             
             if isinstance(get_resp.root, GetTaskSuccessResponse):
                 task = get_resp.root.result
+                state = task.status.state
                 
-                if task.status.state in (TaskState.completed, TaskState.failed, TaskState.canceled, TaskState.rejected):
+                if state in TERMINAL_STATES:
+                    # Если задача готова уже к первому опросу, момент завершения неизвестен
+                    if state == TaskState.completed and last_poll is not None:
+                        # Задача завершилась между двумя опросами - берем середину интервала
+                        TASK_LATENCIES[client.url].append((last_poll + poll_started) / 2 - started)
                     return task
                     
-                print(f"Задача {task_id} в состоянии: {task.status.state}")
-                
-            await asyncio.sleep(0.5)
-            attempts += 1
+                log.info("Задача %s в состоянии: %s", task_id, state)
+                last_poll = poll_started
             
         except Exception as e:
-            print(f"Ошибка при проверке статуса задачи: {e}")
-            await asyncio.sleep(1)
-            attempts += 2
+            # Экспоненциальная задержка со случайным разбросом, чтобы не забивать недоступного агента
+            consecutive_errors += 1
+            delay = random.uniform(0, min(POLL_ERROR_BACKOFF_MAX, POLL_ERROR_BACKOFF * 2 ** consecutive_errors))
+            log.warning("Ошибка при проверке статуса задачи: %s; повтор через %.1f с", e, delay)
+            await asyncio.sleep(delay)
+            continue
+        
+        # Ждем до следующего момента из расписания, после него опрашиваем равномерно
+        elapsed = loop.time() - started
+        while schedule and schedule[0] <= elapsed:
+            schedule.pop(0)
+        await asyncio.sleep(schedule.pop(0) - elapsed if schedule else POLL_INTERVAL)
+
+async def wait_for_task_completion(client, task_id, max_wait_time=30, started=None):
+    """Ждет завершения задачи с таймаутом"""
+    try:
+        return await asyncio.wait_for(_poll_task(client, task_id, started), timeout=max_wait_time)
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"Задача {task_id} не завершилась за {max_wait_time} секунд") from None
+
+async def stream_task_completion(client, params, max_wait_time=30):
+    """Отправляет сообщение потоком и ждет итогового статуса задачи из событий сервера"""
+    request = SendStreamingMessageRequest(params=params)
+    task_id = None
+    completed_task = None
+    
+    try:
+        async with asyncio.timeout(max_wait_time):
+            # aclosing: при ошибке или таймауте поток закрывается сразу, а не сборщиком мусора
+            async with contextlib.aclosing(client.send_message_streaming(request)) as events:
+                async for event in events:
+                    update = getattr(event.root, "result", None)
+                    if update is None:
+                        return None
+                    if isinstance(update, Task):
+                        update_task_id = update.id
+                    elif isinstance(update, TaskStatusUpdateEvent):
+                        update_task_id = update.taskId
+                    else:
+                        continue
+                    
+                    if task_id is None:
+                        task_id = update_task_id
+                        log.info("Создана задача: %s", task_id)
+                    
+                    # Поток дочитывается до конца (агент закрывает его после финального события),
+                    # иначе агент получит разрыв соединения посреди обработки задачи
+                    if update.status.state in TERMINAL_STATES:
+                        if isinstance(update, Task):
+                            completed_task = update
+                        else:
+                            completed_task = Task(id=update.taskId, contextId=update.contextId, status=update.status)
+    except TimeoutError:
+        if task_id is None:
+            raise TimeoutError(f"Агент не создал задачу за {max_wait_time} секунд") from None
+        raise TimeoutError(f"Задача {task_id} не завершилась за {max_wait_time} секунд") from None
     
-    raise TimeoutError(f"Задача {task_id} не завершилась за {max_wait_time} секунд")
+    return completed_task
 
-async def test_expert_agent():
-    """Тестирует эксперта компании напрямую"""
-    print("=== Тестирование Company Expert Agent ===")
+async def _send_agent_task(client, agent_card, params, max_wait_time):
+    if agent_card.capabilities.streaming:
+        return await stream_task_completion(client, params, max_wait_time)
     
-    timeout_config = httpx.Timeout(connect=10.0, read=30.0, write=10.0, pool=10.0)
+    started = asyncio.get_running_loop().time()
+    response = await client.send_message(SendMessageRequest(params=params))
+    task = getattr(response.root, "result", None)
+    if task is None:
+        return None
+    log.info("Создана задача: %s", task.id)
+    return await wait_for_task_completion(client, task.id, max_wait_time, started)
+
+RESULT_CACHE_TTL = 300
+
+# Результаты идемпотентных запросов по (адрес агента, хэш текста); хранится задача,
+# поэтому одновременные одинаковые запросы тоже выполняются один раз
+_RESULT_CACHE: dict[tuple[str, str], tuple[float, asyncio.Task]] = {}
+
+def _forget_failed_result(key, task):
+    # Неудачный результат не кэшируется - следующий запуск обратится к агенту
+    succeeded = (
+        not task.cancelled() and task.exception() is None
+        and task.result() is not None and task.result().status.state == TaskState.completed
+    )
+    if not succeeded and _RESULT_CACHE.get(key, (0, None))[1] is task:
+        del _RESULT_CACHE[key]
+
+async def run_agent_task(client, agent_card, params, max_wait_time=30, cacheable=False):
+    """Отправляет сообщение агенту и возвращает завершенную задачу (None, если задача не создана).
+
+    Если агент поддерживает потоковую передачу, статус задачи приходит от сервера,
+    иначе задача опрашивается через wait_for_task_completion. Для идемпотентных
+    запросов (cacheable) успешный результат переиспользуется RESULT_CACHE_TTL секунд.
+    """
+    if not cacheable:
+        return await _send_agent_task(client, agent_card, params, max_wait_time)
     
-    async with httpx.AsyncClient(timeout=timeout_config) as httpx_client:
+    text = params.message.parts[0].root.text
+    key = (client.url, hashlib.sha256(text.encode()).hexdigest())
+    now = time.monotonic()
+    cached = _RESULT_CACHE.get(key)
+    if cached and cached[0] > now:
+        log.info("Такой же запрос уже выполнялся, используем его результат")
+        task = cached[1]
+    else:
+        task = asyncio.ensure_future(_send_agent_task(client, agent_card, params, max_wait_time))
+        task.add_done_callback(lambda done: _forget_failed_result(key, done))
+        _RESULT_CACHE[key] = (now + RESULT_CACHE_TTL, task)
+    # shield: отмена одного из ожидающих не должна отменять общую задачу
+    return await asyncio.shield(task)
+
+async def test_expert_agent(httpx_client):
+    """Тестирует эксперта компании напрямую"""
+    log.info("=== Тестирование Company Expert Agent ===")
+    
+    try:
         try:
-            try:
-                health_check = await httpx_client.get('http://localhost:10007/health', timeout=5.0)
-                print(f"Expert health check: {health_check.status_code}")
-            except Exception as health_error:
-                print(f"Expert не отвечает на health check: {health_error}")
-                return False
-                
-            expert_client = await A2AClient.get_client_from_agent_card_url(
-                httpx_client, 'http://localhost:10007'
-            )
-            
-            question = "Tell us in detail about Document Analyzer and Vision AI products. What can they do and how much do they cost?"
-            
-            request = SendMessageRequest(
-                params=MessageSendParams(
-                    message={
-                        'role': 'user',
-                        'parts': [{'type': 'text', 'text': question}],
-                        'messageId': uuid4().hex,
-                    }
-                )
-            )
-            
-            print("Отправляем вопрос эксперту...")
-            response = await expert_client.send_message(request)
-            
-            if hasattr(response.root, "result"):
-                task = response.root.result
-                print(f"Создана задача: {task.id}")
-                
-                # Ждем завершения
-                completed_task = await wait_for_task_completion(expert_client, task.id)
-                
-                if completed_task.status.state == TaskState.completed:
-                    print("✅ Эксперт успешно ответил:")
-                    if completed_task.status.message:
-                        print(completed_task.status.message.parts[0].root.text)
-                    return True
-                else:
-                    print(f"❌ Эксперт завершил работу с ошибкой: {completed_task.status.state}")
-                    return False
-            else:
-                print("❌ Не удалось создать задачу для эксперта")
-                return False
+            health_check = await httpx_client.get('http://localhost:10007/health', timeout=HTTP_TIMEOUTS["health"])
+            log.info("Expert health check: %s", health_check.status_code)
+        except Exception as health_error:
+            log.error("Expert не отвечает на health check: %s", health_error)
+            return False
             
-        except Exception as e:
-            print(f"❌ Ошибка при тестировании эксперта: {e}")
+        expert_client, expert_card = await get_agent_client(httpx_client, 'http://localhost:10007')
+        
+        params = message_params(EXPERT_MESSAGE)
+        
+        log.info("Отправляем вопрос эксперту...")
+        completed_task = await run_agent_task(
+            expert_client, expert_card, params, max_wait_time=HTTP_TIMEOUTS["rpc"], cacheable=True)
+        
+        if completed_task is None:
+            log.error("❌ Не удалось создать задачу для эксперта")
+            return False
+        
+        status = completed_task.status
+        if status.state == TaskState.completed:
+            log.info("✅ Эксперт успешно ответил:")
+            if status.message:
+                log.info("%s", status.message.parts[0].root.text)
+            return True
+        else:
+            log.error("❌ Эксперт завершил работу с ошибкой: %s", status.state)
             return False
+        
+    except Exception as e:
+        log.error("❌ Ошибка при тестировании эксперта: %s", e)
+        return False
 
-async def test_manager_agent():
+async def test_manager_agent(httpx_client):
     """Тестирует менеджера с письмом клиента"""
-    print("\n=== Тестирование Sales Manager Agent ===")
-    
-    timeout_config = httpx.Timeout(connect=10.0, read=60.0, write=10.0, pool=10.0)
+    log.info("\n=== Тестирование Sales Manager Agent ===")
     
-    async with httpx.AsyncClient(timeout=timeout_config) as httpx_client:
+    try:
         try:
-            try:
-                health_check = await httpx_client.get('http://localhost:10008/health', timeout=5.0)
-                print(f"Manager health check: {health_check.status_code}")
-            except Exception as health_error:
-                print(f"Manager не отвечает на health check: {health_error}")
-                return False
-                
-            # Подключаемся к менеджеру
-            manager_client = await A2AClient.get_client_from_agent_card_url(
-                httpx_client, 'http://localhost:10008'
-            )
-            
-            request = SendMessageRequest(
-                params=MessageSendParams(
-                    message={
-                        'role': 'user',
-                        'parts': [{'type': 'text', 'text': CLIENT_EMAIL}],
-                        'messageId': uuid4().hex,
-                    }
-                )
-            )
-            
-            print("Отправляем письмо клиента менеджеру...")
-            response = await manager_client.send_message(request)
-            
-            if hasattr(response.root, "result"):
-                task = response.root.result
-                print(f"Создана задача: {task.id}")
-                
-                completed_task = await wait_for_task_completion(manager_client, task.id, max_wait_time=60)
-                
-                if completed_task.status.state == TaskState.completed:
-                    print("✅ Менеджер успешно обработал письмо:")
-                    if completed_task.status.message:
-                        print(completed_task.status.message.parts[0].root.text)
-                    return True
-                else:
-                    print(f"❌ Менеджер завершил работу с ошибкой: {completed_task.status.state}")
-                    if completed_task.status.message:
-                        print(f"Сообщение об ошибке: {completed_task.status.message.parts[0].root.text}")
-                    return False
-            else:
-                print("❌ Не удалось создать задачу для менеджера")
-                return False
+            health_check = await httpx_client.get('http://localhost:10008/health', timeout=HTTP_TIMEOUTS["health"])
+            log.info("Manager health check: %s", health_check.status_code)
+        except Exception as health_error:
+            log.error("Manager не отвечает на health check: %s", health_error)
+            return False
             
-        except Exception as e:
-            print(f"❌ Ошибка при тестировании менеджера: {e}")
+        # Подключаемся к менеджеру
+        manager_client, manager_card = await get_agent_client(httpx_client, 'http://localhost:10008')
+        
+        params = message_params(CLIENT_EMAIL_MESSAGE)
+        
+        log.info("Отправляем письмо клиента менеджеру...")
+        completed_task = await run_agent_task(
+            manager_client, manager_card, params, max_wait_time=HTTP_TIMEOUTS["manager_rpc"])
+        
+        if completed_task is None:
+            log.error("❌ Не удалось создать задачу для менеджера")
             return False
+        
+        status = completed_task.status
+        if status.state == TaskState.completed:
+            log.info("✅ Менеджер успешно обработал письмо:")
+            if status.message:
+                log.info("%s", status.message.parts[0].root.text)
+            return True
+        else:
+            log.error("❌ Менеджер завершил работу с ошибкой: %s", status.state)
+            if status.message:
+                log.info("Сообщение об ошибке: %s", status.message.parts[0].root.text)
+            return False
+        
+    except Exception as e:
+        log.error("❌ Ошибка при тестировании менеджера: %s", e)
+        return False
 
-async def test_simple_calculation():
+async def test_simple_calculation(httpx_client):
     """Тестирует простые расчеты через эксперта"""
-    print("\n=== Тестирование расчетов ===")
+    log.info("\n=== Тестирование расчетов ===")
     
-    timeout_config = httpx.Timeout(connect=10.0, read=30.0, write=10.0, pool=10.0)
+    try:
+        expert_client, expert_card = await get_agent_client(httpx_client, 'http://localhost:10007')
+        
+        params = message_params(CALCULATION_MESSAGE)
+        
+        log.info("Отправляем математический вопрос...")
+        completed_task = await run_agent_task(
+            expert_client, expert_card, params, max_wait_time=HTTP_TIMEOUTS["rpc"], cacheable=True)
+        
+        if completed_task is None:
+            log.error("❌ Не удалось создать задачу для расчетов")
+            return False
+        
+        status = completed_task.status
+        if status.state == TaskState.completed:
+            log.info("✅ Расчеты выполнены:")
+            if status.message:
+                log.info("%s", status.message.parts[0].root.text)
+            return True
+        else:
+            log.error("❌ Ошибка при выполнении расчетов: %s", status.state)
+            return False
+        
+    except Exception as e:
+        log.error("❌ Ошибка при тестировании расчетов: %s", e)
+        return False
+
+# Свой разделитель теста: заголовками «### Answer» эксперт сам разбирает пачки вопросов
+_ANSWER_HEADER_RE = re.compile(r"^\[Test answer\s+(\d+)\]\s*$", re.MULTILINE)
+
+def split_answers(text: str) -> dict[int, str]:
+    """Разбирает ответ на пачку вопросов по заголовкам «[Test answer N]»"""
+    parts = _ANSWER_HEADER_RE.split(text)
+    return {int(number): answer.strip() for number, answer in zip(parts[1::2], parts[2::2])}
+
+async def test_expert_batch(httpx_client):
+    """Задает эксперту вопрос о продуктах и расчетный вопрос одной задачей.
+
+    Возвращает результаты (эксперт, расчеты), как при отдельном запуске тестов.
+    """
+    log.info("=== Тестирование эксперта и расчетов одной задачей ===")
     
-    async with httpx.AsyncClient(timeout=timeout_config) as httpx_client:
-        try:
-            expert_client = await A2AClient.get_client_from_agent_card_url(
-                httpx_client, 'http://localhost:10007'
-            )
-            
-            question = "What is 7 times 8? And also 15 plus 25?"
-            
-            request = SendMessageRequest(
-                params=MessageSendParams(
-                    message={
-                        'role': 'user',
-                        'parts': [{'type': 'text', 'text': question}],
-                        'messageId': uuid4().hex,
-                    }
-                )
-            )
-            
-            print("Отправляем математический вопрос...")
-            response = await expert_client.send_message(request)
-            
-            if hasattr(response.root, "result"):
-                task = response.root.result
-                completed_task = await wait_for_task_completion(expert_client, task.id)
-                
-                if completed_task.status.state == TaskState.completed:
-                    print("✅ Расчеты выполнены:")
-                    if completed_task.status.message:
-                        print(completed_task.status.message.parts[0].root.text)
-                    return True
-                else:
-                    print(f"❌ Ошибка при выполнении расчетов: {completed_task.status.state}")
-                    return False
-            else:
-                print("❌ Не удалось создать задачу для расчетов")
-                return False
-            
-        except Exception as e:
-            print(f"❌ Ошибка при тестировании расчетов: {e}")
+    try:
+        expert_client, expert_card = await get_agent_client(httpx_client, 'http://localhost:10007')
+        
+        params = message_params(BATCH_MESSAGE)
+        
+        log.info("Отправляем эксперту оба вопроса...")
+        completed_task = await run_agent_task(
+            expert_client, expert_card, params, max_wait_time=HTTP_TIMEOUTS["rpc"], cacheable=True)
+        
+        if completed_task is None:
+            log.error("❌ Не удалось создать задачу для эксперта")
+            return False, False
+        
+        status = completed_task.status
+        if status.state != TaskState.completed or not status.message:
+            log.error("❌ Эксперт завершил работу с ошибкой: %s", status.state)
+            return False, False
+        
+        answers = split_answers(status.message.parts[0].root.text)
+        
+        expert_answer = answers.get(1, "")
+        expert_success = bool(expert_answer)
+        if expert_success:
+            log.info("✅ Эксперт успешно ответил:")
+            log.info("%s", expert_answer)
+        else:
+            log.error("❌ В ответе эксперта нет ответа на вопрос о продуктах")
+        
+        calc_answer = answers.get(2, "")
+        calc_success = "56" in calc_answer and "40" in calc_answer
+        if calc_success:
+            log.info("✅ Расчеты выполнены:")
+            log.info("%s", calc_answer)
+        else:
+            log.error("❌ Неверный ответ на расчетный вопрос: %s", calc_answer or 'ответ отсутствует')
+        
+        return expert_success, calc_success
+        
+    except Exception as e:
+        log.error("❌ Ошибка при тестировании эксперта: %s", e)
+        return False, False
+
+# Письма отличаются только текстом строки, начинающейся с "Thank you": ключи кэша должны различаться
+CACHE_KEY_EMAILS = (
+    "Hello,\n\nWe are a logistics company.\nThank you for the brochure. "
+    "We need Vision AI for 40 warehouse cameras and Document Analyzer with SAP integration.\nJohn",
+    "Hello,\n\nWe are a logistics company.\nThank you for the brochure. "
+    "We only need Document Analyzer for PDF invoices, no cameras at all.\nJohn",
+)
+
+def test_expert_cache_key():
+    """Проверяет, что разные запросы клиентов не получают общий ключ кэша ответов эксперта"""
+    log.info("=== Проверка ключа кэша менеджера ===")
+    
+    try:
+        from manager_agent import expert_cache_key
+        
+        first, second = (expert_cache_key(email) for email in CACHE_KEY_EMAILS)
+        if first is None or first == second:
+            log.error("❌ Разные письма получили общий ключ кэша")
+            return False
+        
+        # Подпись отдельной строкой на ключ не влияет
+        signed = CACHE_KEY_EMAILS[0] + "\n\nBest regards,\nJohn Smith"
+        if expert_cache_key(signed) != expert_cache_key(CACHE_KEY_EMAILS[0] + "\n\nThanks!\nJ. Smith"):
+            log.error("❌ Подпись письма влияет на ключ кэша")
             return False
+        
+        log.info("✅ Ключи кэша различают запросы клиентов")
+        return True
+        
+    except Exception as e:
+        log.error("❌ Ошибка при проверке ключа кэша: %s", e)
+        return False
+
+async def warm_up_connections(httpx_client):
+    """Открывает соединения с обоими агентами и запускает получение их карточек.
+
+    Возвращает ответы агентов (или исключения), поэтому служит и проверкой доступности.
+    """
+    # Обращаемся к обоим агентам одновременно; открытые соединения остаются в пуле для тестов
+    expert_check = asyncio.create_task(httpx_client.get('http://localhost:10007/', timeout=HTTP_TIMEOUTS["health"]))
+    manager_check = asyncio.create_task(httpx_client.get('http://localhost:10008/', timeout=HTTP_TIMEOUTS["health"]))
+    expert_resp, manager_resp = await asyncio.gather(expert_check, manager_check, return_exceptions=True)
+    
+    # Карточки запрашиваются по уже открытым соединениям, пока идут следующие шаги
+    if not isinstance(expert_resp, Exception):
+        prefetch_agent_client(httpx_client, 'http://localhost:10007')
+    if not isinstance(manager_resp, Exception):
+        prefetch_agent_client(httpx_client, 'http://localhost:10008')
+    
+    return expert_resp, manager_resp
 
-async def test_agent_availability():
+async def test_agent_availability(httpx_client):
     """Проверяет доступность обоих агентов"""
-    print("=== Проверка доступности агентов ===")
+    log.info("=== Проверка доступности агентов ===")
     
     expert_available = False
     manager_available = False
     
-    async with httpx.AsyncClient(timeout=5.0) as client:
-        # Проверяем эксперта
-        try:
-            expert_resp = await client.get('http://localhost:10007/')
-            expert_available = expert_resp.status_code in [200, 404, 405]
-            print(f"✅ Expert Agent доступен (статус: {expert_resp.status_code})")
-        except Exception as e:
-            print(f"❌ Expert Agent недоступен: {e}")
-        
-        # Проверяем менеджера
-        try:
-            manager_resp = await client.get('http://localhost:10008/')
-            manager_available = manager_resp.status_code in [200, 404, 405]
-            print(f"✅ Manager Agent доступен (статус: {manager_resp.status_code})")
-        except Exception as e:
-            print(f"❌ Manager Agent недоступен: {e}")
+    expert_resp, manager_resp = await warm_up_connections(httpx_client)
+    
+    if isinstance(expert_resp, Exception):
+        log.error("❌ Expert Agent недоступен: %s", expert_resp)
+    else:
+        expert_available = expert_resp.status_code in [200, 404, 405]
+        log.info("✅ Expert Agent доступен (статус: %s)", expert_resp.status_code)
+    
+    if isinstance(manager_resp, Exception):
+        log.error("❌ Manager Agent недоступен: %s", manager_resp)
+    else:
+        manager_available = manager_resp.status_code in [200, 404, 405]
+        log.info("✅ Manager Agent доступен (статус: %s)", manager_resp.status_code)
     
     return expert_available, manager_available
 
-async def test_full_system():
+async def test_full_system(httpx_client):
     """Тестирует полную систему"""
-    print("=== Тестирование полной A2A системы ===")
+    log.info("=== Тестирование полной A2A системы ===")
     
     # Проверяем доступность агентов
-    expert_available, manager_available = await test_agent_availability()
+    expert_available, manager_available = await test_agent_availability(httpx_client)
     
     if not expert_available:
-        print("❌ Expert Agent недоступен. Убедитесь, что он запущен на порту 10007")
+        log.error("❌ Expert Agent недоступен. Убедитесь, что он запущен на порту 10007")
         return
     
     if not manager_available:
-        print("❌ Manager Agent недоступен. Убедитесь, что он запущен на порту 10008")
+        log.error("❌ Manager Agent недоступен. Убедитесь, что он запущен на порту 10008")
         return
     
-    print("\n" + "="*50)
-    expert_success = await test_expert_agent()
+    log.info("\n" + "=" * 50)
+    cache_key_success = test_expert_cache_key()
     
-    print("\n" + "="*50)
-    calc_success = await test_simple_calculation()
+    # Тесты независимы, поэтому запускаются одновременно; их вывод может перемежаться
+    log.info("\n" + "=" * 50)
+    (expert_success, calc_success), manager_success = await asyncio.gather(
+        test_expert_batch(httpx_client),
+        test_manager_agent(httpx_client),
+    )
     
-    print("\n" + "="*50)
-    manager_success = await test_manager_agent()
+    log.info("\n" + "=" * 50)
+    log.info("=== РЕЗУЛЬТАТЫ ТЕСТИРОВАНИЯ ===")
+    log.info("Expert Agent: %s", '✅ РАБОТАЕТ' if expert_success else '❌ ОШИБКА')
+    log.info("Calculations: %s", '✅ РАБОТАЕТ' if calc_success else '❌ ОШИБКА')
+    log.info("Manager Agent: %s", '✅ РАБОТАЕТ' if manager_success else '❌ ОШИБКА')
+    log.info("Cache keys: %s", '✅ РАБОТАЕТ' if cache_key_success else '❌ ОШИБКА')
     
-    print("\n" + "="*50)
-    print("=== РЕЗУЛЬТАТЫ ТЕСТИРОВАНИЯ ===")
-    print(f"Expert Agent: {'✅ РАБОТАЕТ' if expert_success else '❌ ОШИБКА'}")
-    print(f"Calculations: {'✅ РАБОТАЕТ' if calc_success else '❌ ОШИБКА'}")
-    print(f"Manager Agent: {'✅ РАБОТАЕТ' if manager_success else '❌ ОШИБКА'}")
-    
-    if expert_success and manager_success:
-        print("\n🎉 Система A2A работает корректно!")
+    if expert_success and manager_success and cache_key_success:
+        log.info("\n🎉 Система A2A работает корректно!")
     else:
-        print("\n⚠️  Обнаружены проблемы в системе")
+        log.warning("\n⚠️  Обнаружены проблемы в системе")
 
-async def run_interactive_test():
+async def run_interactive_test(httpx_client):
     """Интерактивное тестирование"""
-    print("=== Интерактивное тестирование ===")
+    log.info("=== Интерактивное тестирование ===")
     
     while True:
-        print("\nВыберите тест:")
-        print("1. Проверить доступность агентов")
-        print("2. Протестировать эксперта")
-        print("3. Протестировать расчеты")
-        print("4. Протестировать менеджера")
-        print("5. Полное тестирование системы")
-        print("6. Выход")
+        log.info("\nВыберите тест:")
+        log.info("1. Проверить доступность агентов")
+        log.info("2. Протестировать эксперта")
+        log.info("3. Протестировать расчеты")
+        log.info("4. Протестировать менеджера")
+        log.info("5. Полное тестирование системы")
+        log.info("6. Выход")
         
-        choice = input("\nВведите номер теста: ").strip()
+        # Ввод читается без блокировки цикла, поэтому фоновые задачи и соединения продолжают работать
+        await asyncio.to_thread(flush_log)
+        choice = (await ainput("\nВведите номер теста: ")).strip()
         
         if choice == '1':
-            await test_agent_availability()
+            await test_agent_availability(httpx_client)
         elif choice == '2':
-            await test_expert_agent()
+            await test_expert_agent(httpx_client)
         elif choice == '3':
-            await test_simple_calculation()
+            await test_simple_calculation(httpx_client)
         elif choice == '4':
-            await test_manager_agent()
+            await test_manager_agent(httpx_client)
         elif choice == '5':
-            await test_full_system()
+            await test_full_system(httpx_client)
         elif choice == '6':
-            print("Завершение тестирования...")
+            log.info("Завершение тестирования...")
             break
         else:
-            print("Неверный выбор. Попробуйте еще раз.")
+            log.warning("Неверный выбор. Попробуйте еще раз.")
+
+async def main(interactive: bool = False):
+    """Запускает тесты с общим HTTP клиентом"""
+    # HTTP/2 используется, если агент доступен по https и поддерживает h2, иначе остается HTTP/1.1
+    async with httpx.AsyncClient(timeout=HTTP_TIMEOUT, limits=HTTP_LIMITS, http2=True) as httpx_client:
+        if interactive:
+            # Соединения прогреваются в фоне, пока пользователь выбирает тест;
+            # полный прогон прогревает их своей проверкой доступности
+            warm_up = asyncio.create_task(warm_up_connections(httpx_client))
+            await run_interactive_test(httpx_client)
+            await warm_up
+        else:
+            await test_full_system(httpx_client)
 
 if __name__ == "__main__":
-    print("🚀 Тестирование A2A системы")
-    print("Убедитесь, что запущены оба агента:")
-    print("1. Company Expert Agent на порту 10007")
-    print("2. Sales Manager Agent на порту 10008")
-    print("-" * 50)
+    log_listener = setup_logging()
+    log.info("🚀 Тестирование A2A системы")
+    log.info("Убедитесь, что запущены оба агента:")
+    log.info("1. Company Expert Agent на порту 10007")
+    log.info("2. Sales Manager Agent на порту 10008")
+    log.info("-" * 50)
     
-    import sys
-    if len(sys.argv) > 1 and sys.argv[1] == '--interactive':
-        asyncio.run(run_interactive_test())
-    else:
-        asyncio.run(test_full_system())
\ No newline at end of file
+    try:
+        # uvloop быстрее обрабатывает сокеты и таймеры; без него работает стандартный цикл
+        import uvloop
+        run = uvloop.run
+    except ImportError:
+        run = asyncio.run
+    try:
+        run(main(interactive=len(sys.argv) > 1 and sys.argv[1] == '--interactive'))
+    finally:
+        log_listener.stop()
\ No newline at end of file